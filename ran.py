@@ -1,86 +1,101 @@
 import os
+import bisect
 import random
 import itertools
 import argparse
+import locale
+from operator import itemgetter, not_
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-def parse_notes_in_tracks(track_data):
-    structured_notes = {track: [] for track in track_data.keys() if track not in ['TRACK1', 'TRACK8']}
+#charts are read and the output bytes encoded with this one encoding, so the text round-trips unchanged
+VOX_ENCODING = locale.getpreferredencoding(False)
 
-    for track, notes in track_data.items():
-        if track in ['TRACK1', 'TRACK8']:
-            continue  
+VoxChart = namedtuple('VoxChart', ['segments', 'beat_info', 'end_position', 'tracks'])
 
-        for note_line in notes:
-            note_info = note_line.split('\t') 
-            if len(note_info) >= 3:
-                timestamp, note_type, _ = note_info  
-                structured_notes[track].append({
-                    'timestamp': timestamp,
-                    'type': 'chip' if note_type == '0' else 'hold', 
-                })
+def parse_notes_in_tracks(track_data):
+    """
+    Splits the button and fx tracks into parallel timestamp / is-hold lists.
 
-            #print(f"Parsed {track} note: {note_info}")
+    :param track_data: Track bodies indexed by track, 0 being TRACK1.
+    :return: Dict of track index to a (timestamps, is_hold) tuple of lists.
+    """
+    structured_notes = {}
 
-    return structured_notes
+    for track in range(1, 7):  #skip the lasers
+        notes = track_data[track]
 
-def identify_chip_timestamps(structured_notes):
-    chip_timestamps = {}
-    relevant_tracks = [f'TRACK{i}' for i in range(2, 8)]
+        timestamps = []
+        is_hold = []
+        for note_line in notes:
+            note_info = note_line.split('\t', 2)  #only the first two fields are needed
+            if len(note_info) == 3:
+                timestamp, note_type, _ = note_info
+                timestamps.append(timestamp)
+                is_hold.append(note_type != '0')
 
-    for track in relevant_tracks:
-        for note in structured_notes[track]:
-            if note['type'] == 'chip':
-                timestamp = note['timestamp']
-                if timestamp in chip_timestamps:
-                    chip_timestamps[timestamp] += 1  #increment the counter for this timestamp
-                else:
-                    chip_timestamps[timestamp] = 1  #initialize counter for this new timestamp
+            #print(f"Parsed {track} note: {note_info}")
 
-            #print(f"Processed note in {track}: {note}")
+        structured_notes[track] = (timestamps, is_hold)
 
-    sorted_chip_timestamps = dict(sorted(chip_timestamps.items()))
+    return structured_notes
 
-    return sorted_chip_timestamps
+def tally(structured_notes):
+    """
+    Counts chips and holds per timestamp in a single pass over the notes.
 
-def identify_hold_timestamps(structured_notes):
-    hold_timestamps = {}
-    relevant_tracks = [f'TRACK{i}' for i in range(2, 8)]  #buttons through fx
+    :param structured_notes: Notes per track, as returned by parse_notes_in_tracks.
+    :return: Tuple of sorted (timestamp, count) lists for chips and holds.
+    """
+    chip_timestamps = Counter()
+    hold_timestamps = Counter()
+    relevant_tracks = range(1, 7)  #buttons through fx
 
     for track in relevant_tracks:
-        for note in structured_notes[track]:
-            if note['type'] == 'hold':  #holds
-                timestamp = note['timestamp']
-                if timestamp in hold_timestamps:
-                    hold_timestamps[timestamp] += 1 
-                else:
-                    hold_timestamps[timestamp] = 1  
-
-            #print(f"Processed hold in {track}: {note}")
+        timestamps, is_hold = structured_notes[track]
+        chip_timestamps.update(itertools.compress(timestamps, map(not_, is_hold)))
+        hold_timestamps.update(itertools.compress(timestamps, is_hold))
 
-    sorted_hold_timestamps = dict(sorted(hold_timestamps.items()))
+    return sorted(chip_timestamps.items()), sorted(hold_timestamps.items())
 
-    return sorted_hold_timestamps
 
+def join_lines(lines):
+    return ('\n'.join(lines) + '\n').encode(VOX_ENCODING) if lines else b''
 
-def parse_beat_info(filepath):
+def parse_vox(filepath):
     """
-    Parses the BEAT INFO from a VOX file.
+    Parses a VOX file in a single pass.
 
     :param filepath: Path to the VOX file.
-    :return: List of dictionaries, each representing a time sig change.
+    :return: VoxChart with the output template, time sig changes, end position and track bodies.
+             The template is a list of segments, either literal bytes or a track index (0-7) whose body goes there.
     """
+    segments = []
+    slab = []  #template lines since the last track slot
     beat_info = []
-    with open(filepath, 'r') as file:
-        lines = file.readlines()
-        
-        in_beat_info = False
-        for line in lines:
+    end_position = None
+    tracks = [[] for _ in range(8)]
+
+    state = None  #None, 'BEAT_INFO', 'END_POSITION' or a track index
+    with open(filepath, 'r', encoding=VOX_ENCODING) as file:
+        for line in file:
             line = line.strip()
+
             if line.startswith("#BEAT INFO"):
-                in_beat_info = True
-            elif line.startswith("#END") and in_beat_info:
-                in_beat_info = False
-            elif in_beat_info:
+                state = 'BEAT_INFO'
+            elif line.startswith("#END POSITION"):
+                state = 'END_POSITION'
+            elif line.startswith("#TRACK") and len(line) > 6 and '1' <= line[6] <= '8':
+                state = ord(line[6]) - ord('1')
+                #everything up to and including the track header is shared by all output files
+                slab.append(line)
+                segments.append(join_lines(slab))
+                segments.append(state)
+                slab = []
+                continue
+            elif line.startswith("#END"):
+                state = None
+            elif state == 'BEAT_INFO':
                 parts = line.split('\t')
                 if len(parts) >= 3:
                     measure_info, beats, ticks = parts[0], parts[1], parts[2]
@@ -90,38 +105,24 @@ def parse_beat_info(filepath):
                         'beat': beat,
                         'tick': tick,
                         'beats_per_measure': int(beats),
-                        'ticks_per_beat': int(ticks)  
+                        'ticks_per_beat': int(ticks)
                     })
-    return beat_info
-
-def get_end_position(filepath):
-    """
-    Retrieves the end position of the chart from a VOX file.
-
-    :param filepath: Path to the VOX file.
-    :return: Tuple representing the end position (measure, beat, tick).
-    """
-    with open(filepath, 'r') as file:
-        lines = file.readlines()
-        
-        for i, line in enumerate(lines):
-            line = line.strip()
-            if line.startswith("#END POSITION"):
-                if i + 1 >= len(lines):
-                    print("Unexpected end of file after #END POSITION")
-                    return None
-
-                next_line = lines[i + 1].strip()  
-
-                if next_line.startswith("#END"):
-                    continue  
+            elif state == 'END_POSITION':
+                #only the line right after #END POSITION holds the position
+                if end_position is None:
+                    measure, beat, tick = map(int, line.split(',')[0:3])
+                    end_position = (measure, beat, tick)
+                state = None
+            elif state is not None:
+                #track bodies are spliced into the template per output file
+                tracks[state].append(line)
+                continue
 
-                measure_info = next_line.split(',')[0:3]
-                measure, beat, tick = map(int, measure_info)
-                return (measure, beat, tick)
+            slab.append(line)
 
-    return None  
+    segments.append(join_lines(slab))
 
+    return VoxChart(segments, beat_info, end_position, tracks)
 
 def generate_timestamps(beat_info, end_position):
     """
@@ -129,24 +130,25 @@ def generate_timestamps(beat_info, end_position):
 
     :param beat_info: List of time sig change points.
     :param end_position: Tuple representing the end position (measure, beat, tick).
-    :return: List of timestamps (each a string in the format 'measure,beat,tick').
+    :return: List of timestamps, each a (measure, beat, tick) tuple of ints.
     """
     timestamps = []
     ticks_per_beat = 48 
-    current_beat_info_index = 0
+    end_measure = end_position[0]
 
-    for measure in range(1, end_position[0] + 1):
-        while current_beat_info_index < len(beat_info) - 1 and measure >= beat_info[current_beat_info_index + 1]['measure']:
-            current_beat_info_index += 1
+    #beats per measure for every measure up to the end, each time sig change fills the measures until the next one
+    beats_per_measure = [beat_info[0]['beats_per_measure']] * (end_measure + 1)
+    for change, next_change in zip(beat_info, beat_info[1:] + [None]):
+        start = change['measure']
+        stop = min(next_change['measure'], end_measure + 1) if next_change else end_measure + 1
+        if start < stop:
+            beats_per_measure[start:stop] = [change['beats_per_measure']] * (stop - start)
 
-        beats_per_measure = beat_info[current_beat_info_index]['beats_per_measure']
+    for measure in range(1, end_measure + 1):
+        timestamps.extend(itertools.product((measure,), range(1, beats_per_measure[measure] + 1), range(ticks_per_beat)))
 
-        for beat in range(1, beats_per_measure + 1):
-            for tick in range(0, ticks_per_beat):
-                if (measure, beat, tick) > end_position:
-                    return timestamps 
-                timestamp = f"{measure:03},{beat:02},{tick:02}"
-                timestamps.append(timestamp)
+    #timestamps are in order, so cut everything past the end position in one go
+    del timestamps[bisect.bisect_right(timestamps, end_position):]
 
     return timestamps
 
@@ -155,81 +157,39 @@ def create_directory_for_files(original_file_path):
 
     new_directory_path = os.path.join(os.path.dirname(original_file_path), directory_name)
 
-    if not os.path.exists(new_directory_path):
-        os.makedirs(new_directory_path)
+    os.makedirs(new_directory_path, exist_ok=True)
 
     return new_directory_path
 
-def generate_all_combinations(elements):
-    return list(itertools.permutations(elements))
-
 def randomize_tracks(track_data):
-    tracks_to_randomize = ['TRACK3', 'TRACK4', 'TRACK5', 'TRACK6']
-    
-    original_tracks = {track: track_data[track] for track in tracks_to_randomize + ['TRACK2', 'TRACK7']} 
-
+    tracks_to_randomize = [2, 3, 4, 5]
     random.shuffle(tracks_to_randomize)
 
-    for i, shuffled_track in enumerate(tracks_to_randomize):
-        original_track = 'TRACK' + str(i+3)  
-        track_data[shuffled_track] = original_tracks[original_track]
-
-    swap_tracks_2_and_7 = random.choice([True, False])  
-    if swap_tracks_2_and_7:
-        track_data['TRACK2'], track_data['TRACK7'] = track_data['TRACK7'], track_data['TRACK2']
+    #the bodies of TRACK3 to TRACK6, in order, move onto the shuffled tracks
+    for shuffled_track, body in zip(tracks_to_randomize, track_data[2:6]):
+        track_data[shuffled_track] = body
 
-    randomized_order = tracks_to_randomize.copy()  
-    if swap_tracks_2_and_7:
-        randomized_order.extend(['TRACK7', 'TRACK2']) 
+    randomized_order = tracks_to_randomize
+    if random.getrandbits(1):  #swap fx
+        track_data[1], track_data[6] = track_data[6], track_data[1]
+        randomized_order.extend([6, 1]) 
     else:
-        randomized_order.extend(['TRACK2', 'TRACK7']) 
+        randomized_order.extend([1, 6]) 
 
     return track_data, randomized_order 
 
-def parse_file(filepath):
-    if not os.path.exists(filepath):
-        print("File not found!")
-        return None
-
-    tracks = {f"TRACK{num}": [] for num in range(1, 9)}
-
-    current_track = None
-    with open(filepath, 'r') as file:
-        for line_number, line in enumerate(file, 1): 
-            line = line.strip()
-            #print(f"Reading line {line_number}: {line}") 
-            if line.startswith("#TRACK") and line[6] in "12345678":
-                current_track = line[1:]
-            elif line.startswith("#END"):
-                current_track = None
-            elif current_track:
-                tracks[current_track].append(line)
-
-    return tracks
-
-def write_to_file(filepath, track_data, full_content):
-    new_file_path = filepath.replace('.vox', '.vox')
-
-    with open(new_file_path, 'w') as file:
-        in_track_section = False
-        current_track = None
-
-        for line in full_content:
-            if line.startswith("#TRACK") and line[6] in "12345678":
-                in_track_section = True
-                current_track = line[1:]
-                file.write(line + '\n')  
-
-                for track_line in track_data[current_track]:
-                    file.write(track_line + '\n')
+def emit(filepath, track_bodies, segments):
+    """
+    Writes one output file from the chart template.
 
-            elif line.startswith("#END") and in_track_section:
-                in_track_section = False
-                current_track = None
-                file.write(line + '\n')  
+    :param filepath: Path of the new VOX file.
+    :param track_bodies: Joined bodies for TRACK1 to TRACK8, in output order.
+    :param segments: Template from parse_vox.
+    """
+    content = b''.join([segment if isinstance(segment, bytes) else track_bodies[segment] for segment in segments])
 
-            elif not in_track_section:
-                file.write(line + '\n') 
+    with open(filepath, 'wb') as file:
+        file.write(content)
 
 def main():
     parser = argparse.ArgumentParser(description='Randomize VOX files.')
@@ -246,58 +206,55 @@ def main():
 
     s_random = args.s_random 
 
-    with open(file_path, 'r') as file:
-        full_content = [line.strip() for line in file]
-
-    beat_info = parse_beat_info(file_path)
-    end_position = get_end_position(file_path)
+    segments, _, end_position, track_data = parse_vox(file_path)
 
     if not end_position:
         print("Could not find the end position in the file.")
         return
 
-    timestamps = generate_timestamps(beat_info, end_position)
-
-    track_data = parse_file(file_path)
-
-    structured_notes = parse_notes_in_tracks(track_data)
+    #only s-random needs the note timings, plain track shuffles never read them
+    if s_random:
+        structured_notes = parse_notes_in_tracks(track_data)
 
-    sorted_chip_timestamps = identify_chip_timestamps(structured_notes)
-    print(sorted_chip_timestamps)
-
-    #TODO add hold end timestamps too, to calculate the occupied times
-    sorted_hold_timestamps = identify_hold_timestamps(structured_notes)
-    print(sorted_hold_timestamps)
+        #TODO add hold end timestamps too, to calculate the occupied times
+        sorted_chip_timestamps, sorted_hold_timestamps = tally(structured_notes)
+        print(sorted_chip_timestamps)
+        print(sorted_hold_timestamps)
 
     if track_data:
         original_order = ['a', 'b', 'c', 'd', 'L', 'R'] 
 
-        all_button_combinations = generate_all_combinations(['a', 'b', 'c', 'd'])
-        all_fx_combinations = generate_all_combinations(['L', 'R'])
-
         new_directory = create_directory_for_files(file_path)
 
-        track_identifiers_inverse = {'a': 'TRACK3', 'b': 'TRACK4', 'c': 'TRACK5', 'd': 'TRACK6', 'L': 'TRACK2', 'R': 'TRACK7'}
+        #source track index for each entry of original_order
+        track_identifiers_inverse = (2, 3, 4, 5, 1, 6)
 
-        original_keys = ['TRACK1', 'TRACK8']  
+        #positions in specific_order (buttons, then fx) that feed TRACK2 through TRACK7
+        output_positions = (4, 0, 1, 2, 3, 5)
 
-        base_file_name = os.path.splitext(os.path.basename(file_path))[0]
+        #every combination as (picker for the bodies of TRACK1 to TRACK8, file name suffix), worked out before any output
+        permutations = []
+        for button_combination, fx_combination in itertools.product(itertools.permutations((0, 1, 2, 3)), itertools.permutations((4, 5))):
+            specific_order = button_combination + fx_combination
+            source_tracks = (0, *[track_identifiers_inverse[specific_order[i]] for i in output_positions], 7)  #lasers stay in place
+            permutations.append((itemgetter(*source_tracks), ''.join(original_order[i] for i in specific_order)))
 
-        # Iterate over all combinations
-        for button_combination in all_button_combinations:
-            for fx_combination in all_fx_combinations:
-                specific_order = list(button_combination) + list(fx_combination)
+        #a track's body is the same text wherever it lands, so join each one once for every output file
+        track_blobs = [join_lines(track) for track in track_data]
 
-                specific_track_order = [track_identifiers_inverse[item] for item in specific_order]
+        base_file_name = os.path.splitext(os.path.basename(file_path))[0]
 
-                new_track_data = {}
-                for original_key, new_key in zip(original_keys + specific_track_order, original_keys + ['TRACK3', 'TRACK4', 'TRACK5', 'TRACK6', 'TRACK2', 'TRACK7']):
-                    new_track_data[new_key] = track_data[original_key]
+        new_file_paths = []
+        all_track_bodies = []
 
-                new_file_name = f"{base_file_name}_ran_{''.join(specific_order)}.vox"
-                new_file_path = os.path.join(new_directory, new_file_name)
+        # Iterate over all combinations
+        for pick_tracks, suffix in permutations:
+            new_file_paths.append(os.path.join(new_directory, f"{base_file_name}_ran_{suffix}.vox"))
+            all_track_bodies.append(pick_tracks(track_blobs))
 
-                write_to_file(new_file_path, new_track_data, full_content)
+        #the writes release the GIL and share only read-only data, so emit the files in parallel
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            list(executor.map(emit, new_file_paths, all_track_bodies, itertools.repeat(segments)))  #list() re-raises any write error
 
 if __name__ == "__main__":
     main()